@@ -1,30 +1,228 @@
 from mcp.server.fastmcp import FastMCP
 import pandas as pd
-from collections import Counter
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import scipy.sparse as sp
+import logging
 import os
+import pickle
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import matplotlib
 # Set backend to 'Agg' to prevent server from trying to open a window
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-import seaborn as sns
+from matplotlib.figure import Figure
 from pydantic import BaseModel, Field, ValidationError
 
 # 1. Initialize Server
 mcp = FastMCP("Danbooru-Analytics")
+# Logs go to stderr; stdout carries the MCP stdio protocol
+logger = logging.getLogger(__name__)
 
 # 2. Load Data (Global State)
 base_dir = os.path.dirname(os.path.abspath(__file__))
-parquet_path = os.path.join(base_dir, "metadata.parquet")
+# Prefer the time-sorted rewrite produced by sort_parquet.py, as long as it is not
+# older than the dataset it was made from
+source_parquet_path = os.path.join(base_dir, "metadata.parquet")
+sorted_parquet_path = os.path.join(base_dir, "metadata.sorted.parquet")
+parquet_path = source_parquet_path
+if os.path.exists(sorted_parquet_path):
+    if not os.path.exists(source_parquet_path) or os.path.getmtime(sorted_parquet_path) >= os.path.getmtime(source_parquet_path):
+        parquet_path = sorted_parquet_path
+    else:
+        logger.warning("%s is older than %s; re-run sort_parquet.py. Using the unsorted file.", sorted_parquet_path, source_parquet_path)
+# Bump whenever the cache layout or contents change (tokenizer, row order, ...);
+# caches written under another version are then simply never read
+CACHE_VERSION = 2
+matrix_cache_path = os.path.join(base_dir, f"metadata.tags.v{CACHE_VERSION}.npz")
+vocab_cache_path = os.path.join(base_dir, f"metadata.vocab.v{CACHE_VERSION}.pkl")
+postings_cache_path = os.path.join(base_dir, f"metadata.postings.v{CACHE_VERSION}.npz")
+year_counts_cache_path = os.path.join(base_dir, f"metadata.year_tags.v{CACHE_VERSION}.npy")
 charts_dir = os.path.join(base_dir, "charts")
 
 # Create charts directory if it doesn't exist
 os.makedirs(charts_dir, exist_ok=True)
 
-try:
-    df = pd.read_parquet(parquet_path, columns=["created_at", "tag_string"])
-    df['created_at'] = pd.to_datetime(df['created_at'], utc=True)
-except Exception as e:
-    df = pd.DataFrame()
+
+def build_tag_matrix(tag_strings):
+    """
+    Tokenizes every tag_string once into a sparse (post x tag) matrix.
+
+    Splitting, flattening and vocabulary encoding all run as Arrow compute kernels,
+    so no Python string is created per token.
+
+    Args:
+        tag_strings (pa.ChunkedArray): The space-separated tag strings, one per post.
+
+    Returns:
+        tuple: The CSR matrix (row = post, column = tag id) and the tag -> column vocabulary.
+    """
+    # Tags are separated by ASCII spaces, so the byte-level splitter is enough
+    # and skips Unicode whitespace classification of every character
+    tokens = pc.ascii_split_whitespace(tag_strings)
+    flat = pc.list_flatten(tokens)
+    owners = pc.list_parent_indices(tokens)
+
+    # Leading/trailing whitespace splits into empty tokens
+    keep = pc.not_equal(flat, "")
+    encoded = flat.filter(keep).dictionary_encode().combine_chunks()
+    owners = owners.filter(keep).to_numpy()
+
+    vocab = {t: i for i, t in enumerate(encoded.dictionary.to_pylist())}
+    # 32-bit offsets whenever they fit, matching the int32 column ids from Arrow
+    indptr = np.zeros(len(tag_strings) + 1, dtype=np.int32 if len(encoded) < 2 ** 31 else np.int64)
+    np.cumsum(np.bincount(owners, minlength=len(tag_strings)), out=indptr[1:])
+
+    data = np.ones(len(encoded), dtype=np.int8)
+    matrix = sp.csr_matrix(
+        (data, encoded.indices.to_numpy(zero_copy_only=False, writable=True), indptr),
+        shape=(len(tag_strings), len(vocab))
+    )
+    # A tag repeated within one tag_string must still count its post once
+    # (the column ids are copied out of Arrow's immutable buffer so this can run in place)
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    return matrix, vocab
+
+
+def is_cache_fresh(*paths) -> bool:
+    """
+    Checks that every cache file exists and is at least as new as the parquet.
+
+    Args:
+        *paths (str): Cache file paths.
+
+    Returns:
+        bool: True if all caches can be reused.
+    """
+    return all(os.path.exists(p) and os.path.getmtime(p) >= os.path.getmtime(parquet_path) for p in paths)
+
+
+def write_cache(path: str, write):
+    """
+    Writes a cache file atomically, so an interrupted build never leaves a truncated cache behind.
+
+    Args:
+        path (str): The cache file path.
+        write (Callable): Called as `write(f)` with a binary file object to fill.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_tag_matrix(order):
+    """
+    Loads the tag matrix from the on-disk cache, rebuilding it if the parquet is newer.
+
+    Args:
+        order (np.ndarray): Parquet row positions in upload order; the cached matrix
+            stores its rows in this order.
+
+    Returns:
+        tuple: The CSR matrix and the tag -> column vocabulary.
+    """
+    if is_cache_fresh(matrix_cache_path, vocab_cache_path):
+        try:
+            with open(vocab_cache_path, "rb") as f:
+                matrix, vocab = sp.load_npz(matrix_cache_path).tocsr(), pickle.load(f)
+            if matrix.shape == (len(order), len(vocab)):
+                return matrix, vocab
+            logger.warning("Rebuilding %s: it does not match the dataset", matrix_cache_path)
+        except Exception:
+            logger.warning("Rebuilding unreadable cache %s", matrix_cache_path, exc_info=True)
+
+    tag_strings = pq.read_table(parquet_path, columns=["tag_string"])['tag_string']
+    matrix, vocab = build_tag_matrix(tag_strings)
+    matrix = matrix[order]
+    # Uncompressed: reloading is then a plain read instead of a zlib pass over every entry
+    write_cache(matrix_cache_path, lambda f: sp.save_npz(f, matrix, compressed=False))
+    write_cache(vocab_cache_path, lambda f: pickle.dump(vocab, f, protocol=pickle.HIGHEST_PROTOCOL))
+    return matrix, vocab
+
+
+def load_post_times() -> np.ndarray:
+    """
+    Reads every post's upload time straight from Arrow, without a pandas DataFrame.
+
+    Returns:
+        np.ndarray: Naive UTC datetime64[s] upload times, in parquet row order.
+    """
+    created_at = pq.read_table(parquet_path, columns=["created_at"])['created_at']
+    if not pa.types.is_timestamp(created_at.type):
+        try:
+            # ISO-8601 strings with a UTC offset parse in Arrow's C++ cast kernel
+            created_at = pc.cast(created_at, pa.timestamp("us", tz="UTC"))
+        except pa.ArrowInvalid:
+            # Anything else (e.g. naive strings) goes through pandas' more lenient parser
+            return pd.to_datetime(created_at.to_pandas(), utc=True).dt.tz_convert(None).values.astype('datetime64[s]')
+    # Naive UTC seconds: comparisons stay on plain int64 memory instead of tz-aware Timestamps
+    return created_at.to_numpy().astype('datetime64[s]')
+
+
+def load_tag_postings(matrix):
+    """
+    Loads the inverted index (the CSC form of the tag matrix) from the on-disk cache.
+
+    Args:
+        matrix (sp.csr_matrix): The tag matrix, transposed to CSC on a cache miss.
+
+    Returns:
+        sp.csc_matrix: Column j holds the sorted row positions of posts tagged with tag j.
+    """
+    if is_cache_fresh(postings_cache_path) and os.path.getmtime(postings_cache_path) >= os.path.getmtime(matrix_cache_path):
+        try:
+            postings = sp.load_npz(postings_cache_path).tocsc()
+            if postings.shape == matrix.shape:
+                return postings
+            logger.warning("Rebuilding %s: it does not match the tag matrix", postings_cache_path)
+        except Exception:
+            logger.warning("Rebuilding unreadable cache %s", postings_cache_path, exc_info=True)
+
+    postings = matrix.tocsc()
+    write_cache(postings_cache_path, lambda f: sp.save_npz(f, postings, compressed=False))
+    return postings
+
+
+def load_year_tag_counts() -> np.ndarray:
+    """
+    Loads the per-year tag counts over '1girl' posts, computing and caching them if needed.
+
+    Years are fixed and the dataset is read-only, so this group-by is
+    materialized once instead of on every get_top_waifus_by_year call.
+
+    Returns:
+        np.ndarray: A (len(YEARS), n_tags) int32 matrix; row i counts year YEARS[i].
+    """
+    if post_times.size == 0:
+        return np.zeros((len(YEARS), 0), dtype=np.int32)
+    if is_cache_fresh(year_counts_cache_path) and os.path.getmtime(year_counts_cache_path) >= os.path.getmtime(matrix_cache_path):
+        try:
+            counts = np.load(year_counts_cache_path)
+            # A stale file from a different vocabulary or year range is recomputed
+            if counts.shape == (len(YEARS), len(tag_names)):
+                return counts
+        except Exception:
+            logger.warning("Rebuilding unreadable cache %s", year_counts_cache_path, exc_info=True)
+
+    girl_rows = get_tag_rows('1girl')
+    counts = np.zeros((len(YEARS), len(tag_names)), dtype=np.int32)
+    for i, year in enumerate(YEARS):
+        counts[i] = count_tags(filter_rows_by_year(girl_rows, year))
+    write_cache(year_counts_cache_path, lambda f: np.save(f, counts))
+    return counts
+
 
 # --- CONFIGURATION ---
 SPECIFIC_BANS = {
@@ -46,6 +244,16 @@ BAD_SUFFIXES = (
     '_(costume)', '_(parody)'
 )
 
+# All of BAD_SUFFIXES as one anchored alternation, matched in a single pass
+BAD_SUFFIX_RE = re.compile(r'_\((?:' + '|'.join(re.escape(s[2:-1]) for s in BAD_SUFFIXES) + r')\)$')
+
+# Every year accepted by YearInput, and its [start, end) bounds
+YEARS = range(2005, 2026)
+YEAR_BOUNDS = {
+    y: (np.datetime64(f'{y}-01-01', 's'), np.datetime64(f'{y + 1}-01-01', 's'))
+    for y in YEARS
+}
+
 VIPS = {
     'hatsune_miku', 'hakurei_reimu', 'kirisame_marisa',
     'remilia_scarlet', 'flandre_scarlet', 'kochiya_sanae',
@@ -79,6 +287,195 @@ class CompareInput(BaseModel):
 
 # --- HELPER FUNCTIONS ---
 
+# One persistent Figure/Axes pair per chart kind, redrawn on every render
+chart_figures = {}
+
+# Charts render off the request path. A single worker serializes access to the
+# shared figures; requests for the same chart while it is still rendering are deduplicated.
+plot_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chart")
+# save_path -> ((renderer, arguments), future) of the latest render queued there
+inflight_charts = {}
+inflight_lock = threading.Lock()
+# save_path -> (renderer, arguments) of the chart this process last wrote there successfully
+rendered_charts = {}
+
+# Independent per-tag statistics (e.g. both sides of a comparison) run concurrently
+stats_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="stats")
+
+
+def get_chart_axes(kind: str, figsize: tuple, **margins):
+    """
+    Returns the reusable Figure and Axes for a chart kind, cleared for redrawing.
+
+    Args:
+        kind (str): The chart kind (e.g., 'popularity').
+        figsize (tuple): Figure size in inches, applied when the figure is first created.
+        **margins: Optional `subplots_adjust` margins, applied on creation.
+
+    Returns:
+        tuple: The (Figure, Axes) pair.
+    """
+    if kind not in chart_figures:
+        # Bare Figure objects stay out of pyplot's global figure manager
+        fig = Figure(figsize=figsize)
+        ax = fig.add_subplot()
+        if margins:
+            fig.subplots_adjust(**margins)
+        chart_figures[kind] = (fig, ax)
+
+    fig, ax = chart_figures[kind]
+    ax.clear()
+    return fig, ax
+
+
+def is_same_chart(a, b) -> bool:
+    """
+    Compares two chart specs (renderer and arguments), with array data compared by value.
+
+    Args:
+        a: A renderer argument, or a tuple of them.
+        b: The argument to compare against.
+
+    Returns:
+        bool: True if both would draw the same chart.
+    """
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return isinstance(a, np.ndarray) and isinstance(b, np.ndarray) and np.array_equal(a, b)
+    if isinstance(a, tuple) and isinstance(b, tuple):
+        return len(a) == len(b) and all(is_same_chart(x, y) for x, y in zip(a, b))
+    return bool(a == b)
+
+
+def submit_chart(save_path: str, render, *args):
+    """
+    Queues a chart render on the background plot worker.
+
+    A render of the same chart to the same path that is still pending is reused. Different
+    inputs whose file names collide are queued after it, so the last request wins on disk.
+
+    Args:
+        save_path (str): Where the chart is written.
+        render (Callable): A renderer called as `render(save_path, *args)`.
+        *args: Data for the renderer.
+
+    Returns:
+        Future: The pending (or already queued) render.
+    """
+    spec = (render, args)
+    with inflight_lock:
+        inflight = inflight_charts.get(save_path)
+        if inflight is not None and is_same_chart(inflight[0], spec):
+            return inflight[1]
+        future = plot_pool.submit(render, save_path, *args)
+        inflight_charts[save_path] = (spec, future)
+
+    def forget(done):
+        with inflight_lock:
+            inflight = inflight_charts.get(save_path)
+            if inflight is not None and inflight[1] is done:
+                del inflight_charts[save_path]
+            if done.cancelled() or done.exception() is not None:
+                rendered_charts.pop(save_path, None)
+            else:
+                # The single worker runs renders in order, so this is now what is on disk
+                rendered_charts[save_path] = spec
+        # Nobody waits on the future, so a failed render would otherwise go unnoticed
+        if not done.cancelled() and done.exception() is not None:
+            logger.error("Failed to render chart %s", save_path, exc_info=done.exception())
+
+    future.add_done_callback(forget)
+    return future
+
+
+def submit_chart_once(save_path: str, render, *args):
+    """
+    Queues a chart render unless this process already drew the same chart to save_path.
+
+    Charts from earlier runs, from other inputs that map to the same file name, or that
+    have since been deleted are drawn again.
+
+    Args:
+        save_path (str): Where the chart is written.
+        render (Callable): A renderer called as `render(save_path, *args)`.
+        *args: Data for the renderer; also identifies the chart.
+
+    Returns:
+        Future: The pending render, or None if the chart is already on disk.
+    """
+    with inflight_lock:
+        drawn = save_path in rendered_charts and is_same_chart(rendered_charts[save_path], (render, args))
+    if drawn and os.path.exists(save_path):
+        return None
+    return submit_chart(save_path, render, *args)
+
+
+# --- CHART RENDERERS ---
+
+def render_popularity_chart(save_path: str, character_tag: str, first_month: np.datetime64, counts: np.ndarray):
+    """
+    Draws a character's monthly upload history.
+
+    Args:
+        save_path (str): Output PNG path.
+        character_tag (str): The character tag, used in the title.
+        first_month (np.datetime64): The month of `counts[0]`.
+        counts (np.ndarray): Uploads per consecutive month.
+    """
+    monthly = to_monthly_series(first_month, counts)
+    fig, ax = get_chart_axes("popularity", figsize=(10, 5))
+    ax.plot(monthly.index, monthly.values, color='#ff7f50', linewidth=2)
+    ax.set_title(f"Popularity History: {character_tag}")
+    ax.set_xlabel("Year")
+    ax.set_ylabel("Uploads per Month")
+    ax.grid(True, alpha=0.3)
+    fig.savefig(save_path)
+
+
+def render_drivers_chart(save_path: str, tag: str, year: int, labels: tuple, values: tuple):
+    """
+    Draws the characters driving a tag in a given year as horizontal bars.
+
+    Args:
+        save_path (str): Output PNG path.
+        tag (str): The analyzed tag, used in the title.
+        year (int): The analyzed year, used in the title.
+        labels (tuple): Display names, strongest driver first.
+        values (tuple): Co-occurrence counts matching `labels`.
+    """
+    # Fixed left margin leaves room for the character names without a tight-bbox pass
+    fig, ax = get_chart_axes("drivers", figsize=(10, 6), left=0.28, right=0.97, top=0.92, bottom=0.1)
+    ax.barh(labels, values, color=plt.get_cmap('viridis')(np.linspace(0.2, 0.9, len(values))))
+    # Strongest driver on top
+    ax.invert_yaxis()
+    ax.set_title(f"Top Characters Driving '{tag}' in {year}")
+    ax.set_xlabel("Number of Co-occurrences")
+    fig.savefig(save_path)
+
+
+def render_compare_chart(save_path: str, char1: str, char2: str, monthly1: tuple, monthly2: tuple):
+    """
+    Draws the yearly upload counts of two characters on one chart.
+
+    Args:
+        save_path (str): Output PNG path.
+        char1 (str): First character tag.
+        char2 (str): Second character tag.
+        monthly1 (tuple): get_monthly_counts() result for `char1`.
+        monthly2 (tuple): get_monthly_counts() result for `char2`.
+    """
+    fig, ax = get_chart_axes("compare", figsize=(10, 6))
+    # Resample to Year-End for cleaner comparison lines
+    y1_plot = to_monthly_series(*monthly1).resample('YE').sum()
+    y2_plot = to_monthly_series(*monthly2).resample('YE').sum()
+
+    ax.plot(y1_plot.index, y1_plot.values, label=char1, linewidth=2)
+    ax.plot(y2_plot.index, y2_plot.values, label=char2, linewidth=2, linestyle='--')
+    ax.legend()
+    ax.set_title(f"Head-to-Head: {char1} vs {char2}")
+    ax.grid(True, alpha=0.3)
+    fig.savefig(save_path)
+
+
 def get_safe_filename(query_str: str, prefix: str) -> str:
     """
     Sanitizes tag names for filenames to prevent filesystem errors.
@@ -94,8 +491,268 @@ def get_safe_filename(query_str: str, prefix: str) -> str:
     return os.path.join(charts_dir, f"{prefix}_{safe_tag}.png")
 
 
+@lru_cache(maxsize=4096)
+def get_tag_rows(tag: str) -> np.ndarray:
+    """
+    Finds every post carrying an exact tag.
+
+    Reads the tag's posting list straight out of the inverted index. The result is
+    cached (the dataset is read-only), so it is returned read-only.
+
+    Args:
+        tag (str): The Danbooru tag (e.g., 'hatsune_miku').
+
+    Returns:
+        np.ndarray: Sorted post row positions (empty if the tag is unknown).
+    """
+    col = tag_vocab.get(tag)
+    if col is None:
+        rows = np.empty(0, dtype=np.int32)
+    else:
+        rows = tag_postings.indices[tag_postings.indptr[col]:tag_postings.indptr[col + 1]]
+    rows.setflags(write=False)
+    return rows
+
+
+@lru_cache(maxsize=2048)
+def get_monthly_counts(tag: str) -> tuple:
+    """
+    Counts uploads per calendar month for a tag.
+
+    Same bins as `resample('ME').size()` over the tag's posts, computed with a
+    single `np.bincount` over precomputed month codes. The counts are cached and read-only.
+
+    Args:
+        tag (str): The Danbooru tag (e.g., 'hatsune_miku').
+
+    Returns:
+        tuple: The first month (np.datetime64[M]) and the uploads for every month from
+            there to the tag's last upload, gaps included as 0; (None, empty) if none
+            of the tag's posts has an upload time.
+    """
+    # Posts without an upload time sort last; they have no month to count in
+    rows = get_tag_rows(tag)
+    codes = post_month_codes[rows[:np.searchsorted(rows, dated_post_count)]]
+    if codes.size == 0:
+        return None, np.zeros(0, dtype=np.int64)
+
+    # Rows are in upload order, so the first and last codes bound the range
+    first = codes[0]
+    counts = np.bincount(codes - first)
+    counts.setflags(write=False)
+    return np.datetime64(int(first), 'M'), counts
+
+
+def to_monthly_series(first_month: np.datetime64, counts: np.ndarray) -> pd.Series:
+    """
+    Wraps monthly counts in a Series indexed by month end (UTC), like `resample('ME')`.
+
+    Args:
+        first_month (np.datetime64): The month of `counts[0]`.
+        counts (np.ndarray): Uploads per consecutive month.
+
+    Returns:
+        pd.Series: The counts with a month-end DatetimeIndex.
+    """
+    if len(counts) == 0:
+        return pd.Series(counts, index=pd.DatetimeIndex([], tz="UTC"))
+    index = pd.date_range(pd.Timestamp(first_month, tz="UTC"), periods=len(counts), freq='ME')
+    return pd.Series(counts, index=index)
+
+
+def filter_rows_by_year(rows: np.ndarray, year: int) -> np.ndarray:
+    """
+    Keeps only the posts uploaded during a given year.
+
+    Since posts are sorted by upload time, the year is a contiguous row range and
+    only needs two binary searches instead of a full-table date mask.
+
+    Args:
+        rows (np.ndarray): Sorted post row positions.
+        year (int): The year to keep (must be a key of YEAR_BOUNDS).
+
+    Returns:
+        np.ndarray: The subset of `rows` that falls within the year.
+    """
+    lo, hi = np.searchsorted(post_times, YEAR_BOUNDS[year])
+    return rows[np.searchsorted(rows, lo):np.searchsorted(rows, hi)]
+
+
+def count_shared_rows(rows1: np.ndarray, rows2: np.ndarray) -> int:
+    """
+    Counts the posts two sorted posting lists have in common.
+
+    Args:
+        rows1 (np.ndarray): Sorted, unique row positions.
+        rows2 (np.ndarray): Sorted, unique row positions.
+
+    Returns:
+        int: The size of the intersection.
+    """
+    small, large = sorted((rows1, rows2), key=len)
+    if small.size == 0:
+        return 0
+
+    # Very lopsided lists: binary-search each small entry instead of merging both
+    if len(large) > 32 * len(small):
+        pos = np.searchsorted(large, small)
+        pos[pos == len(large)] = 0
+        return int(np.count_nonzero(large[pos] == small))
+
+    return int(np.intersect1d(small, large, assume_unique=True).size)
+
+
+def is_character_tag(tag: str) -> bool:
+    """
+    Decides whether a tag names an actual character rather than metadata.
+
+    Args:
+        tag (str): The Danbooru tag.
+
+    Returns:
+        bool: True for VIPs and '_(...)'-qualified tags without a banned suffix.
+    """
+    if tag in SPECIFIC_BANS:
+        return False
+    is_vip = tag in VIPS
+    has_parens = '_(' in tag and tag.endswith(')')
+    return (is_vip or has_parens) and not BAD_SUFFIX_RE.search(tag)
+
+
+def count_tags(rows: np.ndarray) -> np.ndarray:
+    """
+    Counts tag occurrences over a set of posts.
+
+    Args:
+        rows (np.ndarray): Row positions of the posts to aggregate.
+
+    Returns:
+        np.ndarray: One count per vocabulary column.
+    """
+    # int32 accumulator: scipy would otherwise widen the int8 entries to int64
+    return np.asarray(tag_matrix[rows].sum(axis=0, dtype=np.int32)).ravel()
+
+
+def top_tags(counts: np.ndarray, k: int) -> list:
+    """
+    Picks the k most frequent tags out of a per-column count vector.
+
+    Args:
+        counts (np.ndarray): One count per vocabulary column.
+        k (int): How many tags to return.
+
+    Returns:
+        list: (tag, count) pairs, most frequent first; tags with a zero count are never returned.
+    """
+    n = len(counts)
+    k = min(k, n)
+    if k == 0:
+        return []
+
+    # One linear selection pass over the vocab finds the k-th largest count; everything
+    # tied with it stays a candidate so the cut below does not depend on column order
+    kth = max(np.partition(counts, n - k)[n - k], 1)
+    top = np.flatnonzero(counts >= kth)
+    # Most frequent first, ties broken alphabetically
+    top = top[np.lexsort((tag_name_ranks[top], -counts[top]))][:k]
+    return [(tag_names[i], int(counts[i])) for i in top]
+
+
+def rank_characters(counts: np.ndarray, k: int, exclude: str = None) -> list:
+    """
+    Ranks the most frequent character tags; shared by the year and tag-driver tools.
+
+    Args:
+        counts (np.ndarray): One count per vocabulary column (e.g., from count_tags).
+        k (int): How many characters to return.
+        exclude (str, optional): A tag to leave out of the ranking.
+
+    Returns:
+        list: (tag, count) pairs, most frequent first.
+    """
+    counts = np.where(character_tag_mask, counts, 0)
+    if exclude in tag_vocab:
+        counts[tag_vocab[exclude]] = 0
+    return top_tags(counts, k)
+
+
+def format_tag_name(text: str) -> str:
+    """
+    Turns a raw tag (or text containing one) into a display name.
+
+    Args:
+        text (str): e.g., 'rem_(re:zero)'.
+
+    Returns:
+        str: e.g., 'Rem [Re:Zero]'.
+    """
+    return text.replace('_', ' ').title().replace('(', '[').replace(')', ']')
+
+
+# --- DATA LOADING ---
+# Placed after the helpers it calls (get_tag_rows, count_tags, is_character_tag, ...)
+
+try:
+    post_times = load_post_times()
+    # Keep posts in upload order so every year is a contiguous block of rows
+    order = np.argsort(post_times, kind='stable')
+    post_times = post_times[order]
+    # Tags live in the sparse matrix; row i is the post at post_times[i]
+    tag_matrix, tag_vocab = load_tag_matrix(order)
+    # Inverted index: column j of the CSC copy is the sorted posting list of tag j
+    tag_postings = load_tag_postings(tag_matrix)
+    # Posts with a missing upload time (NaT) sort last; rows below this count are dated
+    dated_post_count = int(np.count_nonzero(~np.isnat(post_times)))
+    # Calendar month of every post as months since 1970-01, shared by all monthly aggregations
+    # (only meaningful for the dated rows)
+    post_month_codes = post_times.astype('datetime64[M]').astype(np.int32)
+    # Column id -> tag name (the vocab is built in column order)
+    tag_names = list(tag_vocab)
+    # Alphabetical position of every column, used to break ties between equal counts
+    tag_name_ranks = np.empty(len(tag_names), dtype=np.int32)
+    tag_name_ranks[np.argsort(np.array(tag_names, dtype=object), kind='stable')] = np.arange(len(tag_names), dtype=np.int32)
+    # The vocabulary never changes at runtime, so the predicate is evaluated once per tag
+    character_tag_mask = np.fromiter((is_character_tag(t) for t in tag_names), dtype=bool, count=len(tag_names))
+    year_tag_counts = load_year_tag_counts()
+except Exception:
+    logger.exception("Failed to load the dataset from %s", parquet_path)
+    post_times = np.empty(0, dtype='datetime64[s]')
+    tag_matrix, tag_vocab = None, {}
+    tag_postings = None
+    dated_post_count = 0
+    post_month_codes = np.empty(0, dtype=np.int32)
+    tag_names = []
+    tag_name_ranks = np.empty(0, dtype=np.int32)
+    character_tag_mask = np.zeros(0, dtype=bool)
+    year_tag_counts = np.zeros((len(YEARS), 0), dtype=np.int32)
+
+
 # --- TOOLS ---
 
+@lru_cache(maxsize=256)
+def top_waifus_report(year: int) -> str:
+    """
+    Builds the get_top_waifus_by_year response for an already validated year.
+
+    The dataset is read-only, so the report is a pure function of its arguments and cached.
+
+    Args:
+        year (int): A year from YEARS.
+
+    Returns:
+        str: The formatted top 10 list.
+    """
+    # Every '1girl' post counts its own '1girl' tag, so an all-zero row means no posts
+    counts = year_tag_counts[YEARS.index(year)]
+
+    if not counts.any():
+        return f"No data found for {year}."
+
+    clean_names = [format_tag_name(t) for t, count in rank_characters(counts, 10)]
+
+    return f"🏆 Top 10 Waifus of {year}:\n" + "\n".join([f"{i + 1}. {n}" for i, n in enumerate(clean_names)])
+
+
 @mcp.tool()
 def get_top_waifus_by_year(year: int):
     """
@@ -110,7 +767,7 @@ def get_top_waifus_by_year(year: int):
     Returns:
         str: A formatted list of the top 10 characters or an error message.
     """
-    if df.empty: return "Error: Dataset not loaded."
+    if post_times.size == 0: return "Error: Dataset not loaded."
 
     # Validate Input using Pydantic
     try:
@@ -118,38 +775,7 @@ def get_top_waifus_by_year(year: int):
     except ValidationError as e:
         return f"Input Error: {e}"
 
-    start_date = f"{year}-01-01"
-    end_date = f"{year}-12-31"
-
-    mask = (
-            (df['created_at'] >= start_date) &
-            (df['created_at'] <= end_date) &
-            (df['tag_string'].str.contains('1girl', regex=False, na=False))
-    )
-    subset = df.loc[mask]
-
-    if subset.empty:
-        return f"No data found for {year}."
-
-    all_tags = " ".join(subset['tag_string'].dropna()).split()
-    counts = Counter(all_tags)
-
-    top_chars = []
-
-    # Deep scan of top 5000 to find valid characters
-    for tag, count in counts.most_common(5000):
-        if tag in SPECIFIC_BANS: continue
-        is_vip = tag in VIPS
-        has_parens = '_(' in tag and tag.endswith(')')
-
-        if is_vip or has_parens:
-            if not tag.endswith(BAD_SUFFIXES):
-                top_chars.append(tag)
-        if len(top_chars) == 10: break
-
-    clean_names = [t.replace('_', ' ').title().replace('(', '[').replace(')', ']') for t in top_chars]
-
-    return f"🏆 Top 10 Waifus of {year}:\n" + "\n".join([f"{i + 1}. {n}" for i, n in enumerate(clean_names)])
+    return top_waifus_report(year)
 
 
 @mcp.tool()
@@ -163,34 +789,27 @@ def get_character_stats(character_tag: str):
     Returns:
         str: A summary of total artworks, peak popularity, and the path to the saved graph.
     """
-    if df.empty: return "Error: Dataset not loaded."
+    if post_times.size == 0: return "Error: Dataset not loaded."
 
-    mask = df['tag_string'].str.contains(character_tag, regex=False, na=False)
-    subset = df.loc[mask]
+    rows = get_tag_rows(character_tag)
 
-    if subset.empty:
+    if rows.size == 0:
         return f"No data found for tag: {character_tag}. Check spelling on Danbooru."
 
     # 1. Stats
-    total = len(subset)
-    monthly = subset.set_index('created_at').resample('ME').size()
-    peak_date = monthly.idxmax()
-    peak_count = monthly.max()
-
-    # 2. Generate Plot
-    plt.figure(figsize=(10, 5))
-    plt.plot(monthly.index, monthly.values, color='#ff7f50', linewidth=2)
-    plt.title(f"Popularity History: {character_tag}")
-    plt.xlabel("Year")
-    plt.ylabel("Uploads per Month")
-    plt.grid(True, alpha=0.3)
-
-    # 3. Save Figure
+    total = len(rows)
+    first_month, monthly = get_monthly_counts(character_tag)
+    if monthly.size == 0:
+        return f"No upload dates found for tag: {character_tag} ({total:,} artworks)."
+    peak_i = int(monthly.argmax())
+    peak_date = (first_month + peak_i).astype(object)
+    peak_count = monthly[peak_i]
+
+    # 2. Render Plot in the background
     save_path = get_safe_filename(character_tag, "popularity")
-    plt.savefig(save_path)
-    plt.close()
+    submit_chart(save_path, render_popularity_chart, character_tag, first_month, monthly)
 
-    status = 'Still Active' if monthly.iloc[-1] > 20 else 'Declining'
+    status = 'Still Active' if monthly[-1] > 20 else 'Declining'
 
     return f"""
     📊 Stats for '{character_tag}':
@@ -214,97 +833,97 @@ def calculate_ship_dependency(char1: str, char2: str):
     Returns:
         str: A statistical summary of their co-occurrence.
     """
-    if df.empty: return "Error: Dataset not loaded."
+    if post_times.size == 0: return "Error: Dataset not loaded."
 
-    mask1 = df['tag_string'].str.contains(char1, regex=False, na=False)
-    set1 = set(df.loc[mask1].index)
-    if not set1: return f"Character {char1} not found."
+    rows1 = get_tag_rows(char1)
+    if rows1.size == 0: return f"Character {char1} not found."
 
-    mask2 = df['tag_string'].str.contains(char2, regex=False, na=False)
-    set2 = set(df.loc[mask2].index)
+    rows2 = get_tag_rows(char2)
 
-    intersection = len(set1.intersection(set2))
-    percentage = (intersection / len(set1)) * 100
+    intersection = count_shared_rows(rows1, rows2)
+    percentage = (intersection / len(rows1)) * 100
 
     return f"""
     ❤️ Ship Analysis:
     - When {char1} is drawn, {char2} appears {percentage:.1f}% of the time.
-    - {char1} Total Images: {len(set1)}
+    - {char1} Total Images: {len(rows1)}
     - Joint Images: {intersection}
     """
 
 
-@mcp.tool()
-def analyze_tag_driver(year: int, tag: str):
+@lru_cache(maxsize=256)
+def tag_driver_report(year: int, tag: str) -> tuple:
     """
-    Identifies drivers for a trend and saves a bar chart.
+    Builds the analyze_tag_driver response for an already validated year.
+
+    The dataset is read-only, so the report is a pure function of its arguments and cached.
+    The chart itself is drawn by the caller, which can tell whether it is still on disk.
 
     Args:
-        year (int): The year to investigate.
-        tag (str): The trait/tag to analyze (e.g., 'black_hair').
+        year (int): A year from YEARS.
+        tag (str): The trait/tag to analyze.
 
     Returns:
-        str: A list of the top 5 characters driving the tag's popularity and a saved chart path.
+        tuple: The top drivers summary (with the chart path), and the chart path and
+            render_drivers_chart arguments (None if there is nothing to plot).
     """
-    if df.empty: return "Error: Dataset not loaded."
-
-    # Validate Input using Pydantic logic
-    try:
-        YearInput(year=year)
-    except ValidationError:
-        return "Error: Year must be between 2005 and 2025."
-
-    start_date = f"{year}-01-01"
-    end_date = f"{year}-12-31"
-
-    mask = (
-            (df['created_at'] >= start_date) &
-            (df['created_at'] <= end_date) &
-            (df['tag_string'].str.contains(tag, regex=False, na=False))
-    )
-    subset = df.loc[mask]
-
-    if subset.empty: return f"No data found for tag '{tag}' in {year}."
+    rows = filter_rows_by_year(get_tag_rows(tag), year)
 
-    all_tags = " ".join(subset['tag_string'].dropna()).split()
-    counts = Counter(all_tags)
+    if rows.size == 0: return f"No data found for tag '{tag}' in {year}.", None
 
     top_drivers = []
     plot_labels = []
     plot_values = []
 
-    for t, count in counts.most_common(2000):
-        if t == tag or t in SPECIFIC_BANS: continue
-        is_vip = t in VIPS
-        has_parens = '_(' in t and t.endswith(')')
-
-        if is_vip or has_parens:
-            if not t.endswith(BAD_SUFFIXES):
-                fmt_name = t.replace('_', ' ').title().replace('(', '').replace(')', '')
-                top_drivers.append(f"{t} ({count})")
-                plot_labels.append(fmt_name)
-                plot_values.append(count)
-        if len(top_drivers) == 5: break
-
-    # Generate Plot
-    plt.figure(figsize=(10, 6))
-    sns.barplot(x=plot_values, y=plot_labels, palette="viridis")
-    plt.title(f"Top Characters Driving '{tag}' in {year}")
-    plt.xlabel("Number of Co-occurrences")
+    # The analyzed tag trivially co-occurs with itself
+    for t, count in rank_characters(count_tags(rows), 5, exclude=tag):
+        fmt_name = t.replace('_', ' ').title().replace('(', '').replace(')', '')
+        top_drivers.append(f"{t} ({count})")
+        plot_labels.append(fmt_name)
+        plot_values.append(count)
 
     save_path = get_safe_filename(f"{year}_{tag}", "drivers")
-    plt.savefig(save_path, bbox_inches='tight')
-    plt.close()
+    chart = (save_path, (tag, year, tuple(plot_labels), tuple(plot_values)))
 
-    clean_drivers = [d.replace('_', ' ').title().replace('(', '[').replace(')', ']') for d in top_drivers]
+    clean_drivers = [format_tag_name(d) for d in top_drivers]
 
     return f"""
     🕵️ Analysis of '{tag}' in {year}:
-    - Total Images: {len(subset)}
+    - Total Images: {len(rows)}
     - Top Drivers: {', '.join(clean_drivers)}
 
     🖼️ **Graph Saved:** {save_path}
+    """, chart
+
+
+@mcp.tool()
+def analyze_tag_driver(year: int, tag: str):
+    """
+    Identifies drivers for a trend and saves a bar chart.
+
+    Args:
+        year (int): The year to investigate.
+        tag (str): The trait/tag to analyze (e.g., 'black_hair').
+
+    Returns:
+        str: A list of the top 5 characters driving the tag's popularity and a saved chart path.
     """
+    if post_times.size == 0: return "Error: Dataset not loaded."
+
+    # Validate Input using Pydantic logic
+    try:
+        YearInput(year=year)
+    except ValidationError:
+        return "Error: Year must be between 2005 and 2025."
+
+    report, chart = tag_driver_report(year, tag)
+
+    # Render Plot in the background, unless this exact chart is already on disk
+    if chart is not None:
+        save_path, args = chart
+        submit_chart_once(save_path, render_drivers_chart, *args)
+
+    return report
 
 
 @mcp.tool()
@@ -319,35 +938,24 @@ def compare_characters(char1: str, char2: str):
     Returns:
         str: Head-to-head stats and a saved comparison chart.
     """
-    if df.empty: return "Error: Dataset not loaded."
+    if post_times.size == 0: return "Error: Dataset not loaded."
 
     def get_stats(tag):
-        mask = df['tag_string'].str.contains(tag, regex=False, na=False)
-        subset = df.loc[mask]
-        if subset.empty: return None, None
-        return len(subset), subset.set_index('created_at').resample('ME').size()
+        rows = get_tag_rows(tag)
+        if rows.size == 0: return None, None
+        return len(rows), get_monthly_counts(tag)
 
-    total1, yearly1 = get_stats(char1)
-    total2, yearly2 = get_stats(char2)
+    # Both lookups are independent and spend their time in GIL-releasing NumPy kernels
+    future1 = stats_pool.submit(get_stats, char1)
+    future2 = stats_pool.submit(get_stats, char2)
+    (total1, yearly1), (total2, yearly2) = future1.result(), future2.result()
 
     if total1 is None: return f"❌ {char1} not found"
     if total2 is None: return f"❌ {char2} not found"
 
-    # Plot Comparison
-    plt.figure(figsize=(10, 6))
-    # Resample to Year-End for cleaner comparison lines
-    y1_plot = yearly1.resample('YE').sum()
-    y2_plot = yearly2.resample('YE').sum()
-
-    plt.plot(y1_plot.index, y1_plot.values, label=char1, linewidth=2)
-    plt.plot(y2_plot.index, y2_plot.values, label=char2, linewidth=2, linestyle='--')
-    plt.legend()
-    plt.title(f"Head-to-Head: {char1} vs {char2}")
-    plt.grid(True, alpha=0.3)
-
+    # Render Comparison in the background
     save_path = get_safe_filename(f"{char1}_vs_{char2}", "compare")
-    plt.savefig(save_path)
-    plt.close()
+    submit_chart(save_path, render_compare_chart, char1, char2, yearly1, yearly2)
 
     winner = char1 if total1 > total2 else char2
 
@@ -0,0 +1,72 @@
+"""
+One-time rewrite of metadata.parquet into metadata.sorted.parquet, sorted by upload time.
+
+Sorting by `created_at` keeps each year in a handful of small row groups with tight
+min/max statistics, so readers can prune whole row groups for year-scoped queries.
+`created_at` is stored as a UTC timestamp, which makes those statistics chronological
+and lets the server skip parsing strings on startup. server.py picks up the sorted
+file automatically unless metadata.parquet is newer (re-run this script after updating it).
+
+Usage:
+    python sort_parquet.py
+"""
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+source_path = os.path.join(base_dir, "metadata.parquet")
+target_path = os.path.join(base_dir, "metadata.sorted.parquet")
+
+ROW_GROUP_SIZE = 262144
+UTC_TIMESTAMP = pa.timestamp("us", tz="UTC")
+
+
+def parse_created_at(created_at):
+    """
+    Parses the raw created_at strings into UTC timestamps, like server.load_post_times.
+
+    Args:
+        created_at (pa.ChunkedArray): The created_at column.
+
+    Returns:
+        pa.ChunkedArray: The column as timestamp[us, tz=UTC].
+    """
+    if pa.types.is_timestamp(created_at.type):
+        return created_at
+    try:
+        # ISO-8601 strings with a UTC offset parse in Arrow's C++ cast kernel
+        return pc.cast(created_at, UTC_TIMESTAMP)
+    except pa.ArrowInvalid:
+        # Anything else (e.g. naive strings) goes through pandas' more lenient parser
+        parsed = pd.to_datetime(created_at.to_pandas(), utc=True)
+        return pa.chunked_array([pa.Array.from_pandas(parsed).cast(UTC_TIMESTAMP, safe=False)])
+
+
+def main():
+    # 1. Load the full table so the rewrite keeps every column
+    table = pq.read_table(source_path)
+
+    # 2. Sort chronologically; the raw strings carry varying UTC offsets, so parse them first
+    created_at = parse_created_at(table['created_at'])
+    col = table.schema.get_field_index('created_at')
+    table = table.set_column(col, 'created_at', created_at)
+    table = table.take(pc.sort_indices(created_at))
+
+    # 3. Write small, statistics-rich row groups. tag_string is almost unique per post,
+    # so dictionary pages would only add a decode pass there.
+    pq.write_table(
+        table, target_path,
+        row_group_size=ROW_GROUP_SIZE,
+        compression='zstd',
+        use_dictionary=[name for name in table.column_names if name != 'tag_string'],
+        write_statistics=True,
+        sorting_columns=[pq.SortingColumn(column_index=col, descending=False, nulls_first=False)],
+    )
+    print(f"Wrote {table.num_rows:,} rows to {target_path}")
+
+
+if __name__ == "__main__":
+    main()